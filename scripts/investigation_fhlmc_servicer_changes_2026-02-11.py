@@ -10,8 +10,12 @@ Columns: Loan Identifier, Servicer Name, Current Investor Loan UPB.
 Output: CSV with one row per (servicer_from, servicer_to, transition_month).
 """
 
-import gc
+import multiprocessing as mp
+import os
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
 import polars as pl
@@ -21,6 +25,19 @@ OUTPUT_CSV = Path("output/investigation_fhlmc_servicer_changes_2026-02-11.csv")
 
 COLS = ["Loan Identifier", "Servicer Name", "Current Investor Loan UPB"]
 
+# Each pair runs in its own worker process; cap the Polars pool per worker so
+# the workers don't oversubscribe the cores between them
+THREADS_PER_WORKER = 2
+
+# Each worker holds a month pair in memory (~1.2 GB per month), so the pool is
+# capped by memory as well as cores: 6 workers stay well under the ~27 GB the
+# sliding window exists to avoid, however many cores the machine has
+MAX_WORKERS = 6
+
+# Months of results buffered in memory before they are spilled to a parquet
+# chunk, so the buffer stays bounded regardless of history length
+SPILL_EVERY = 12
+
 
 def extract_month(p: Path) -> str:
     """Extract YYYYMM from filename like fu190606.parquet.
@@ -35,9 +52,125 @@ def extract_month(p: Path) -> str:
     return f"{yyyy}{mm}"
 
 
-def load_month(path: Path) -> pl.DataFrame:
-    """Load a single monthly file with column projection."""
-    return pl.scan_parquet(path).select(COLS).collect()
+def load_month(path: Path) -> pl.LazyFrame:
+    """Lazily scan a single monthly file with column projection.
+
+    Only 3 columns are read per row group, so row groups (rather than
+    columns) are decoded in parallel. Servicer Name is cast to Categorical
+    (~50 distinct names) so the group-bys hash 32-bit codes instead of strings.
+    UPB is cast to Float64 so months stored as Int64 aggregate to the same
+    dtype and the per-pair results still stack.
+    """
+    return pl.scan_parquet(path, parallel="row_groups").select(COLS).with_columns(
+        pl.col("Servicer Name").cast(pl.Categorical),
+        pl.col("Current Investor Loan UPB").cast(pl.Float64),
+    )
+
+
+def process_pair(prev_path: Path, curr_path: Path) -> tuple[pl.DataFrame, int, int, float]:
+    """Compare two consecutive monthly files.
+
+    Returns the (servicer_from, servicer_to) aggregation for the transition
+    month with its fraction columns, the number of loans present in both
+    months, the number whose servicer changed, and the elapsed seconds.
+    """
+    t0 = time.perf_counter()
+    month_curr = extract_month(curr_path)
+
+    lf_prev = load_month(prev_path)
+    lf_curr = load_month(curr_path)
+
+    # Inner join on Loan Identifier, filtered straight to servicer changes so
+    # the planner drops the unchanged majority right after the join probe
+    changed = lf_prev.select(
+        "Loan Identifier",
+        pl.col("Servicer Name").alias("servicer_from"),
+        pl.col("Current Investor Loan UPB").alias("upb_from"),
+    ).join(
+        lf_curr.select(
+            "Loan Identifier",
+            pl.col("Servicer Name").alias("servicer_to"),
+            pl.col("Current Investor Loan UPB").alias("upb_to"),
+        ),
+        on="Loan Identifier",
+        how="inner",
+    ).filter(pl.col("servicer_from") != pl.col("servicer_to"))
+
+    # Loans present in both months: a keys-only semi-join, no payload columns
+    in_both = lf_prev.join(
+        lf_curr.select("Loan Identifier"), on="Loan Identifier", how="semi"
+    ).select(pl.len())
+
+    # Servicer book sizes for the fraction columns, from the same two scans:
+    # the seller's book in the month before the transition, the buyer's in
+    # the transition month
+    seller_totals = lf_prev.group_by(
+        pl.col("Servicer Name").alias("servicer_from")
+    ).agg(
+        pl.len().alias("seller_total_n"),
+        pl.col("Current Investor Loan UPB").sum().alias("seller_total_upb"),
+    )
+    buyer_totals = lf_curr.group_by(
+        pl.col("Servicer Name").alias("servicer_to")
+    ).agg(
+        pl.len().alias("buyer_total_n"),
+        pl.col("Current Investor Loan UPB").sum().alias("buyer_total_upb"),
+    )
+
+    agg = (
+        changed.group_by("servicer_from", "servicer_to")
+        .agg(
+            pl.len().alias("n_loans"),
+            pl.col("upb_from").sum().alias("total_upb_from"),
+            pl.col("upb_to").sum().alias("total_upb"),
+        )
+        .join(seller_totals, on="servicer_from", how="left")
+        .join(buyer_totals, on="servicer_to", how="left")
+        .select(
+            # Back to plain strings for the hand-off to the parent process
+            pl.col("servicer_from", "servicer_to").cast(pl.Utf8),
+            "n_loans",
+            "total_upb",
+            pl.lit(month_curr).alias("transition_month"),
+            (pl.col("n_loans") / pl.col("seller_total_n")).alias("frac_seller_n"),
+            (pl.col("total_upb_from") / pl.col("seller_total_upb")).alias("frac_seller_upb"),
+            (pl.col("n_loans") / pl.col("buyer_total_n")).alias("frac_buyer_n"),
+            (pl.col("total_upb") / pl.col("buyer_total_upb")).alias("frac_buyer_upb"),
+        )
+    )
+
+    # Execute the whole pair as one plan: the scans are shared between the
+    # aggregation, the book totals and the n_both count
+    agg, in_both = pl.collect_all([agg, in_both], engine="streaming")
+    n_both = in_both.item()
+    n_changed = agg["n_loans"].sum()
+
+    return agg, n_both, n_changed, time.perf_counter() - t0
+
+
+@contextmanager
+def worker_threads(n: int):
+    """Set POLARS_MAX_THREADS only while worker processes are being started.
+
+    Spawned workers copy the environment at start-up and import Polars (which
+    sizes its thread pool) before a pool initializer would run, so the cap must
+    be in the environment at spawn time. The parent's value is restored after.
+    """
+    prev = os.environ.get("POLARS_MAX_THREADS")
+    os.environ["POLARS_MAX_THREADS"] = str(n)
+    try:
+        yield
+    finally:
+        if prev is None:
+            del os.environ["POLARS_MAX_THREADS"]
+        else:
+            os.environ["POLARS_MAX_THREADS"] = prev
+
+
+def spill_results(frames: list[pl.LazyFrame], path: Path) -> None:
+    """Write buffered results to a parquet chunk and clear the buffer."""
+    pl.concat(frames, rechunk=False).sink_parquet(path)
+    frames.clear()
 
 
 def main():
@@ -52,121 +185,81 @@ def main():
     # -----------------------------------------------------------------------
     # Sliding window: compare consecutive month pairs
     # -----------------------------------------------------------------------
-    all_results: list[pl.DataFrame] = []
-    t_total = time.perf_counter()
-
-    df_prev = load_month(files[0])
-    print(f"Loaded {extract_month(files[0])}: {df_prev.height:>10,} loans")
-
-    for i in range(1, len(files)):
-        t0 = time.perf_counter()
-        month_prev = extract_month(files[i - 1])
-        month_curr = extract_month(files[i])
-
-        df_curr = load_month(files[i])
-
-        # Servicer-level totals for fraction columns
-        seller_totals = (
-            df_prev.group_by("Servicer Name")
-            .agg(
-                pl.col("Loan Identifier").count().alias("seller_total_n"),
-                pl.col("Current Investor Loan UPB").sum().alias("seller_total_upb"),
-            )
-            .rename({"Servicer Name": "servicer_from"})
-        )
-        buyer_totals = (
-            df_curr.group_by("Servicer Name")
-            .agg(
-                pl.col("Loan Identifier").count().alias("buyer_total_n"),
-                pl.col("Current Investor Loan UPB").sum().alias("buyer_total_upb"),
-            )
-            .rename({"Servicer Name": "servicer_to"})
-        )
-
-        # Inner join on Loan Identifier
-        joined = df_prev.select(
-            "Loan Identifier",
-            pl.col("Servicer Name").alias("servicer_from"),
-            pl.col("Current Investor Loan UPB").alias("upb_from"),
-        ).join(
-            df_curr.select(
-                "Loan Identifier",
-                pl.col("Servicer Name").alias("servicer_to"),
-                pl.col("Current Investor Loan UPB").alias("upb_to"),
-            ),
-            on="Loan Identifier",
-            how="inner",
-        )
-
-        n_both = joined.height
-        changed = joined.filter(pl.col("servicer_from") != pl.col("servicer_to"))
-        n_changed = changed.height
-        pct = n_changed / n_both * 100 if n_both > 0 else 0.0
-
-        if n_changed > 0:
-            agg = (
-                changed.group_by("servicer_from", "servicer_to")
-                .agg(
-                    pl.col("Loan Identifier").count().alias("n_loans"),
-                    pl.col("upb_from").sum().alias("total_upb_from"),
-                    pl.col("upb_to").sum().alias("total_upb"),
-                )
-                .with_columns(pl.lit(month_curr).alias("transition_month"))
-                # Join seller totals
-                .join(seller_totals, on="servicer_from", how="left")
-                # Join buyer totals
-                .join(buyer_totals, on="servicer_to", how="left")
-                # Compute fractions
-                .with_columns(
-                    (pl.col("n_loans") / pl.col("seller_total_n")).alias("frac_seller_n"),
-                    (pl.col("total_upb_from") / pl.col("seller_total_upb")).alias("frac_seller_upb"),
-                    (pl.col("n_loans") / pl.col("buyer_total_n")).alias("frac_buyer_n"),
-                    (pl.col("total_upb") / pl.col("buyer_total_upb")).alias("frac_buyer_upb"),
-                )
-                # Drop intermediate columns
-                .drop(
-                    "total_upb_from",
-                    "seller_total_n",
-                    "seller_total_upb",
-                    "buyer_total_n",
-                    "buyer_total_upb",
+    # Spilled chunks live in a temporary directory that is removed on exit,
+    # including when the run fails part-way
+    with tempfile.TemporaryDirectory(prefix="fhlmc_servicer_changes_") as tmp:
+        spill_dir = Path(tmp)
+        all_results: list[pl.LazyFrame] = []
+        n_chunks = 0
+        t_total = time.perf_counter()
+
+        # Pairs are independent, so fan them out across worker processes
+        pairs = list(zip(files, files[1:]))
+        n_workers = max(1, min(MAX_WORKERS, (os.cpu_count() or 2) // 2))
+
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context("spawn")) as executor:
+            # map() submits every pair up front, which starts all the workers
+            with worker_threads(THREADS_PER_WORKER):
+                results = executor.map(process_pair, *zip(*pairs))
+
+            for i, ((prev_path, curr_path), (agg, n_both, n_changed, elapsed)) in enumerate(
+                zip(pairs, results), start=1
+            ):
+                pct = n_changed / n_both * 100 if n_both > 0 else 0.0
+
+                if n_changed > 0:
+                    all_results.append(agg.lazy())
+
+                print(
+                    f"  {extract_month(prev_path)} -> {extract_month(curr_path)}: "
+                    f"{n_both:>10,} in both, {n_changed:>8,} changed ({pct:>5.2f}%)  "
+                    f"[{elapsed:.1f}s]"
                 )
-            )
-            all_results.append(agg)
-
-        elapsed = time.perf_counter() - t0
-        print(
-            f"  {month_prev} -> {month_curr}: "
-            f"{n_both:>10,} in both, {n_changed:>8,} changed ({pct:>5.2f}%)  "
-            f"[{elapsed:.1f}s]"
-        )
 
-        # Slide window
-        df_prev = df_curr
-        del joined, changed
-        gc.collect()
+                if i % SPILL_EVERY == 0 and all_results:
+                    spill_results(all_results, spill_dir / f"chunk_{n_chunks:03d}.parquet")
+                    n_chunks += 1
 
-    total_elapsed = time.perf_counter() - t_total
-    print(f"\nAll pairs processed in {total_elapsed / 60:.1f} minutes")
+        if all_results:
+            spill_results(all_results, spill_dir / f"chunk_{n_chunks:03d}.parquet")
+            n_chunks += 1
 
-    # -----------------------------------------------------------------------
-    # Combine, sort, write CSV
-    # -----------------------------------------------------------------------
-    if not all_results:
-        print("No servicer changes detected.")
-        return
+        total_elapsed = time.perf_counter() - t_total
+        print(f"\nAll pairs processed in {total_elapsed / 60:.1f} minutes")
 
-    combined = pl.concat(all_results).sort(
-        ["transition_month", "n_loans"], descending=[False, True]
-    )
+        # -------------------------------------------------------------------
+        # Combine, sort, write CSV
+        # -------------------------------------------------------------------
+        if n_chunks == 0:
+            print("No servicer changes detected.")
+            return
 
-    OUTPUT_CSV.parent.mkdir(parents=True, exist_ok=True)
-    combined.write_csv(OUTPUT_CSV)
+        combined = pl.scan_parquet(spill_dir / "chunk_*.parquet").sort(
+            ["transition_month", "n_loans"], descending=[False, True]
+        )
 
-    print(f"\nWrote {combined.height:,} rows to {OUTPUT_CSV}")
-    print(f"Total loan-level servicer changes: {combined['n_loans'].sum():,}")
-    print(f"Total UPB transferred: ${combined['total_upb'].sum() / 1e9:,.1f}B")
-    print(f"Unique (from, to) pairs: {combined.select('servicer_from', 'servicer_to').unique().height:,}")
+        # Stream the sorted result straight to disk rather than materializing it
+        OUTPUT_CSV.parent.mkdir(parents=True, exist_ok=True)
+        schema = combined.collect_schema()
+        combined.sink_csv(OUTPUT_CSV)
+
+    # Summarize from the written CSV so the joins and sort above run only once
+    written = pl.scan_csv(OUTPUT_CSV, schema=schema)
+    summary, top20 = pl.collect_all([
+        written.select(
+            pl.len().alias("n_rows"),
+            pl.col("n_loans").sum(),
+            pl.col("total_upb").sum(),
+            pl.struct("servicer_from", "servicer_to").n_unique().alias("n_pairs"),
+        ),
+        written.sort("n_loans", descending=True).head(20),
+    ])
+    n_rows, n_loans, total_upb, n_pairs = summary.row(0)
+
+    print(f"\nWrote {n_rows:,} rows to {OUTPUT_CSV}")
+    print(f"Total loan-level servicer changes: {n_loans:,}")
+    print(f"Total UPB transferred: ${total_upb / 1e9:,.1f}B")
+    print(f"Unique (from, to) pairs: {n_pairs:,}")
 
     # -----------------------------------------------------------------------
     # Top 20 largest single-month transitions
@@ -175,8 +268,7 @@ def main():
     print("TOP 20 LARGEST SINGLE-MONTH TRANSITIONS")
     print("=" * 120)
 
-    top20 = combined.sort("n_loans", descending=True).head(20)
-    for row in top20.iter_rows(named=True):
+    for row in top20.rows(named=True):
         print(
             f"  {row['transition_month']}: "
             f"{row['servicer_from'][:40]:40s} -> {row['servicer_to'][:40]:40s} "
@@ -6,23 +6,26 @@ data has an explicit Seller Issuer ID field — populated ONLY when an MSR trans
 occurs. This script processes all available months (Apr 2015+), builds an issuer
 ID → name lookup, and produces a CSV matching the FNMA output format.
 
-Data sources: llmon1 + llmon2 L records, deduplicated on (Pool ID, Loan Seq, As-of Date).
+Data sources: llmon1 + llmon2 L records, deduplicated on (Pool ID, Loan Seq, As-of Date),
+read from the Arrow IPC copies that prepare_gnma_silver.py brings up to date at
+the start of each run.
 Issuer lookup: issrcutoff (bronze) + nissues D (silver).
 
 Output: CSV with one row per (seller, buyer, transition_month) aggregation.
 """
 
-import gc
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import polars as pl
 
+from prepare_gnma_silver import prepare_all
+
 # ---------------------------------------------------------------------------
 # Paths
 # ---------------------------------------------------------------------------
-LLMON1_L_DIR = Path("data/gnma/silver/llmon1/L/")
-LLMON2_L_DIR = Path("data/gnma/silver/llmon2/L/")
 ISSRCUTOFF_DIR = Path("data/gnma/bronze/issrcutoff/")
 NISSUES_DIR = Path("data/gnma/silver/nissues/D/")
 OUTPUT_CSV = Path("output/investigation_gnma_servicer_changes_2026-02-11.csv")
@@ -32,75 +35,92 @@ OUTPUT_CSV = Path("output/investigation_gnma_servicer_changes_2026-02-11.csv")
 # ---------------------------------------------------------------------------
 COL_ISSUER = "Issuer ID (including for loan packages in MIP pool)"
 COL_SELLER = "Seller Issuer ID"
-COL_UPB = "Unpaid Principal Balance (UPB of the loan)"
 COL_DATE = "As of Date (CCYYMM)"
 COL_POOL = "Pool ID"
-COL_LOAN_NEW = "Disclosure Sequence Number (A sequence number unique to loan level)"
-COL_LOAN_OLD = "Disclosure Sequence Number (A sequence number unique to loan level )"  # trailing space
 COL_LOAN = "loan_seq"
 
+# Months of results buffered in memory before they are spilled to a parquet
+# chunk, so the buffer stays bounded regardless of history length
+SPILL_EVERY = 12
+
 
 def extract_month(f: Path) -> str:
-    """Extract YYYYMM from filename like llmon1_201504_L.parquet."""
+    """Extract YYYYMM from filename like llmon1_201504_L.arrow."""
     return f.stem.split("_")[1]
 
 
-def build_issuer_lookup() -> dict[str, str]:
-    """Build issuer ID → name mapping from issrcutoff + nissues D files."""
+def build_issuer_lookup() -> pl.DataFrame:
+    """Build issuer ID → name lookup table from issrcutoff + nissues D files."""
     print("=" * 90)
     print("BUILDING ISSUER ID → NAME LOOKUP")
     print("=" * 90)
 
-    name_map: dict[str, str] = {}
-
-    # Source 1: nissues D files (older, filled first so issrcutoff overwrites)
+    # Source 1: nissues D files (older, listed first so issrcutoff overwrites)
     nissues_files = sorted(NISSUES_DIR.glob("*.parquet"))
-    for f in nissues_files:
-        df = (
-            pl.scan_parquet(f)
-            .select(
-                pl.col("Issuer Number").alias("issuer_id"),
-                pl.col("Issuer Name").alias("issuer_name"),
-            )
-            .collect()
+    nissues = pl.concat([
+        pl.scan_parquet(f).select(
+            pl.col("Issuer Number").cast(pl.Utf8).alias("issuer_id"),
+            pl.col("Issuer Name").cast(pl.Utf8).alias("issuer_name"),
         )
-        for row in df.iter_rows(named=True):
-            name_map[row["issuer_id"]] = row["issuer_name"]
-    print(f"  nissues D:    {len(name_map)} issuers from {len(nissues_files)} files")
+        for f in nissues_files
+    ])
 
     # Source 2: issrcutoff files (more recent, overwrites older names)
     issrcutoff_files = sorted(ISSRCUTOFF_DIR.glob("*.parquet"))
-    for f in issrcutoff_files:
-        df = (
-            pl.scan_parquet(f)
-            .with_columns(
-                pl.col("text_content").str.slice(0, 4).str.strip_chars().alias("issuer_id"),
-                pl.col("text_content").str.slice(4, 56).str.strip_chars().alias("issuer_name"),
-            )
-            .select("issuer_id", "issuer_name")
-            .collect()
+    # Scanned per file so each only has to carry text_content, not match the
+    # first file's schema; an empty directory just contributes no rows
+    issrcutoff = [
+        pl.scan_parquet(f).select(
+            pl.col("text_content").str.slice(0, 4).str.strip_chars().alias("issuer_id"),
+            pl.col("text_content").str.slice(4, 56).str.strip_chars().alias("issuer_name"),
         )
-        for row in df.iter_rows(named=True):
-            name_map[row["issuer_id"]] = row["issuer_name"]
-    print(f"  Combined:     {len(name_map)} unique issuers\n")
+        for f in issrcutoff_files
+    ]
+
+    # Rows are in source/file order, so keeping the last row per ID gives the
+    # most recent name
+    n_nissues, lookup_df = pl.collect_all([
+        nissues.select(pl.col("issuer_id").n_unique()),
+        pl.concat([nissues, *issrcutoff]).unique(subset="issuer_id", keep="last"),
+    ])
+    print(f"  nissues D:    {n_nissues.item()} issuers from {len(nissues_files)} files")
+    print(f"  Combined:     {lookup_df.height} unique issuers\n")
+
+    return lookup_df
+
+
+def load_month(paths: list[Path]) -> pl.DataFrame:
+    """Load one month of llmon1 + llmon2 L records, deduplicated on (Pool ID, loan seq).
+
+    The prepared IPC files already carry upb_dollars and have blank seller IDs
+    nulled, so this is a memory-mapped read plus the dedup.
+    """
+    # Issuer IDs are low-cardinality 4-char codes: cast to Categorical so the
+    # group-bys and joins compare 32-bit codes
+    return (
+        pl.scan_ipc(paths)
+        .with_columns(pl.col(COL_ISSUER, COL_SELLER).cast(pl.Categorical))
+        .unique(subset=[COL_POOL, COL_LOAN])
+        .collect()
+    )
 
-    return name_map
 
+def spill_results(frames: list[pl.LazyFrame], path: Path) -> None:
+    """Write buffered results to a parquet chunk and clear the buffer."""
+    pl.concat(frames, rechunk=False).sink_parquet(path)
+    frames.clear()
 
-def main():
-    name_map = build_issuer_lookup()
 
-    def issuer_name(iid: str) -> str:
-        return name_map.get(iid, f"ID:{iid}")
+def main():
+    lookup_df = build_issuer_lookup()
+    seller_names = lookup_df.rename({"issuer_id": COL_SELLER, "issuer_name": "servicer_from"})
+    buyer_names = lookup_df.rename({"issuer_id": COL_ISSUER, "issuer_name": "servicer_to"})
 
     # -----------------------------------------------------------------------
-    # Discover and sort all llmon1/llmon2 L files (Apr 2015+)
+    # Discover all llmon1/llmon2 L files (Apr 2015+), preparing any IPC copy
+    # that is missing or stale so no source month is silently dropped
     # -----------------------------------------------------------------------
-    llmon1_files = sorted(LLMON1_L_DIR.glob("llmon1_*_L.parquet"))
-    llmon2_files = sorted(LLMON2_L_DIR.glob("llmon2_*_L.parquet"))
-
-    llmon1_files = [f for f in llmon1_files if extract_month(f) >= "201504"]
-    llmon2_files = [f for f in llmon2_files if extract_month(f) >= "201504"]
+    llmon1_files, llmon2_files = prepare_all()
 
     files_by_month: dict[str, list[Path]] = {}
     for f in llmon1_files + llmon2_files:
@@ -117,167 +137,167 @@ def main():
     print("PROCESSING ALL MONTHS")
     print("=" * 90)
 
-    all_results: list[pl.DataFrame] = []
-    t_total = time.perf_counter()
-
-    for i, month in enumerate(months):
-        t0 = time.perf_counter()
-        month_frames = []
-
-        for f in files_by_month[month]:
-            lf = pl.scan_parquet(f)
-            schema_cols = lf.collect_schema().names()
-
-            if COL_LOAN_NEW in schema_cols:
-                loan_col = COL_LOAN_NEW
-            elif COL_LOAN_OLD in schema_cols:
-                loan_col = COL_LOAN_OLD
-            else:
-                continue
-
-            df = lf.select(
-                pl.col(COL_POOL),
-                pl.col(loan_col).alias(COL_LOAN),
-                pl.col(COL_ISSUER),
-                pl.col(COL_SELLER),
-                pl.col(COL_UPB),
-            ).collect()
-            month_frames.append(df)
-
-        # Combine llmon1 + llmon2, deduplicate
-        df_month = pl.concat(month_frames).unique(subset=[COL_POOL, COL_LOAN])
-        total = df_month.height
-
-        # Parse UPB to dollars (stored as string in cents)
-        df_month = df_month.with_columns(
-            (
-                pl.col(COL_UPB)
-                .str.strip_chars()
-                .replace("", None)
-                .cast(pl.Float64, strict=False)
-                / 100
-            ).alias("upb_dollars")
-        )
-
-        # Servicer totals by Issuer ID (= current servicer in this month)
-        servicer_totals = df_month.group_by(COL_ISSUER).agg(
-            pl.len().alias("servicer_total_n"),
-            pl.col("upb_dollars").sum().alias("servicer_total_upb"),
+    # Spilled chunks live in a temporary directory that is removed on exit,
+    # including when the run fails part-way
+    with tempfile.TemporaryDirectory(prefix="gnma_servicer_changes_") as tmp:
+        spill_dir = Path(tmp)
+        all_results: list[pl.LazyFrame] = []
+        n_chunks = 0
+        t_total = time.perf_counter()
+
+        # One-slot prefetch: month i+1 is loaded in the background while month i
+        # is processed (Polars releases the GIL during the read)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future_next = executor.submit(load_month, files_by_month[months[0]])
+
+            for i, month in enumerate(months):
+                t0 = time.perf_counter()
+
+                df_month = future_next.result()
+                if i + 1 < len(months):
+                    future_next = executor.submit(load_month, files_by_month[months[i + 1]])
+                total = df_month.height
+
+                # Filter to transfers (Seller Issuer ID populated; blanks nulled by prep)
+                transfers = df_month.filter(pl.col(COL_SELLER).is_not_null())
+                n_transfers = transfers.height
+                pct = n_transfers / total * 100 if total > 0 else 0.0
+
+                if n_transfers > 0:
+                    # Aggregate by (seller_id, buyer_id)
+                    agg = (
+                        transfers.group_by(COL_SELLER, COL_ISSUER)
+                        .agg(
+                            pl.len().alias("n_loans"),
+                            pl.col("upb_dollars").sum().alias("total_upb"),
+                        )
+                        .with_columns(pl.lit(month).alias("transition_month"))
+                    )
+
+                    # Servicer totals by issuer ID, from one group-by over the month's
+                    # loans (keyed by current Issuer ID) stacked with its transfers
+                    # (keyed by Seller Issuer ID):
+                    # - buyer's book = loans it services this month (untagged rows)
+                    # - seller's pre-transfer book ≈ remaining + transferred (all rows)
+                    stacked = pl.concat([
+                        df_month.select(
+                            pl.col(COL_ISSUER).alias("issuer"),
+                            "upb_dollars",
+                            pl.lit(False).alias("is_transfer"),
+                        ),
+                        transfers.select(
+                            pl.col(COL_SELLER).alias("issuer"),
+                            "upb_dollars",
+                            pl.lit(True).alias("is_transfer"),
+                        ),
+                    ], rechunk=False)
+                    servicer_totals = stacked.group_by("issuer").agg(
+                        (~pl.col("is_transfer")).sum().alias("buyer_total_n"),
+                        pl.col("upb_dollars").filter(~pl.col("is_transfer")).sum().alias("buyer_total_upb"),
+                        pl.len().alias("seller_total_n"),
+                        pl.col("upb_dollars").sum().alias("seller_total_upb"),
+                    )
+
+                    # Join buyer totals (buyer = current Issuer ID), then seller totals
+                    agg = agg.join(
+                        servicer_totals.select(
+                            pl.col("issuer").alias(COL_ISSUER), "buyer_total_n", "buyer_total_upb"
+                        ),
+                        on=COL_ISSUER,
+                        how="left",
+                    ).join(
+                        servicer_totals.select(
+                            pl.col("issuer").alias(COL_SELLER), "seller_total_n", "seller_total_upb"
+                        ),
+                        on=COL_SELLER,
+                        how="left",
+                    )
+
+                    # Compute fractions
+                    agg = agg.with_columns(
+                        (pl.col("n_loans") / pl.col("seller_total_n")).alias("frac_seller_n"),
+                        (pl.col("total_upb") / pl.col("seller_total_upb")).alias("frac_seller_upb"),
+                        (pl.col("n_loans") / pl.col("buyer_total_n")).alias("frac_buyer_n"),
+                        (pl.col("total_upb") / pl.col("buyer_total_upb")).alias("frac_buyer_upb"),
+                    )
+
+                    # Resolve names (unknown IDs fall back to "ID:<id>"), keep raw IDs
+                    agg = agg.with_columns(
+                        pl.col(COL_SELLER, COL_ISSUER).cast(pl.Utf8)
+                    ).join(
+                        seller_names, on=COL_SELLER, how="left"
+                    ).join(
+                        buyer_names, on=COL_ISSUER, how="left"
+                    ).with_columns(
+                        pl.col(COL_SELLER).alias("seller_issuer_id"),
+                        pl.col(COL_ISSUER).alias("issuer_id"),
+                        pl.col("servicer_from").fill_null(pl.concat_str(pl.lit("ID:"), pl.col(COL_SELLER))),
+                        pl.col("servicer_to").fill_null(pl.concat_str(pl.lit("ID:"), pl.col(COL_ISSUER))),
+                    ).select(
+                        "seller_issuer_id", "servicer_from",
+                        "issuer_id", "servicer_to",
+                        "transition_month",
+                        "n_loans", "total_upb",
+                        "frac_seller_n", "frac_seller_upb",
+                        "frac_buyer_n", "frac_buyer_upb",
+                    )
+
+                    all_results.append(agg.lazy())
+
+                elapsed = time.perf_counter() - t0
+
+                if (i + 1) % 12 == 0 or i == len(months) - 1:
+                    print(
+                        f"  {month}: {total:>10,} loans, {n_transfers:>8,} transfers ({pct:>5.2f}%)  "
+                        f"[{elapsed:.1f}s]  ({i+1}/{len(months)})"
+                    )
+
+                if (i + 1) % SPILL_EVERY == 0 and all_results:
+                    spill_results(all_results, spill_dir / f"chunk_{n_chunks:03d}.parquet")
+                    n_chunks += 1
+
+                del df_month, transfers
+
+        if all_results:
+            spill_results(all_results, spill_dir / f"chunk_{n_chunks:03d}.parquet")
+            n_chunks += 1
+
+        total_elapsed = time.perf_counter() - t_total
+        print(f"\nAll months processed in {total_elapsed / 60:.1f} minutes")
+
+        # -------------------------------------------------------------------
+        # Combine, sort, write CSV
+        # -------------------------------------------------------------------
+        if n_chunks == 0:
+            print("No transfers detected.")
+            return
+
+        combined = pl.scan_parquet(spill_dir / "chunk_*.parquet").sort(
+            ["transition_month", "n_loans"], descending=[False, True]
         )
 
-        # Filter to transfers (Seller Issuer ID populated)
-        transfers = df_month.filter(
-            pl.col(COL_SELLER).is_not_null()
-            & (pl.col(COL_SELLER).str.strip_chars() != "")
-        )
-        n_transfers = transfers.height
-        pct = n_transfers / total * 100 if total > 0 else 0.0
-
-        if n_transfers > 0:
-            # Aggregate by (seller_id, buyer_id)
-            agg = (
-                transfers.group_by(COL_SELLER, COL_ISSUER)
-                .agg(
-                    pl.len().alias("n_loans"),
-                    pl.col("upb_dollars").sum().alias("total_upb"),
-                )
-                .with_columns(pl.lit(month).alias("transition_month"))
-            )
-
-            # Join buyer totals (buyer = current Issuer ID)
-            agg = agg.join(
-                servicer_totals.rename({
-                    COL_ISSUER: COL_ISSUER,
-                    "servicer_total_n": "buyer_total_n",
-                    "servicer_total_upb": "buyer_total_upb",
-                }),
-                on=COL_ISSUER,
-                how="left",
-            )
-
-            # Seller totals: loans still serviced by seller + loans transferred away
-            # In this month, seller's remaining book = servicer_totals[seller_id]
-            # Seller's pre-transfer book ≈ remaining + transferred
-            seller_transferred = (
-                transfers.group_by(COL_SELLER)
-                .agg(
-                    pl.len().alias("seller_xfer_n"),
-                    pl.col("upb_dollars").sum().alias("seller_xfer_upb"),
-                )
-            )
-            seller_remaining = (
-                servicer_totals.rename({
-                    COL_ISSUER: COL_SELLER,
-                    "servicer_total_n": "seller_remain_n",
-                    "servicer_total_upb": "seller_remain_upb",
-                })
-            )
-            seller_book = seller_transferred.join(
-                seller_remaining, on=COL_SELLER, how="left"
-            ).with_columns(
-                (pl.col("seller_xfer_n") + pl.col("seller_remain_n").fill_null(0)).alias("seller_total_n"),
-                (pl.col("seller_xfer_upb") + pl.col("seller_remain_upb").fill_null(0)).alias("seller_total_upb"),
-            ).select(COL_SELLER, "seller_total_n", "seller_total_upb")
-
-            agg = agg.join(seller_book, on=COL_SELLER, how="left")
-
-            # Compute fractions
-            agg = agg.with_columns(
-                (pl.col("n_loans") / pl.col("seller_total_n")).alias("frac_seller_n"),
-                (pl.col("total_upb") / pl.col("seller_total_upb")).alias("frac_seller_upb"),
-                (pl.col("n_loans") / pl.col("buyer_total_n")).alias("frac_buyer_n"),
-                (pl.col("total_upb") / pl.col("buyer_total_upb")).alias("frac_buyer_upb"),
-            )
-
-            # Resolve names, keep raw IDs
-            agg = agg.with_columns(
-                pl.col(COL_SELLER).alias("seller_issuer_id"),
-                pl.col(COL_ISSUER).alias("issuer_id"),
-                pl.col(COL_SELLER).map_elements(issuer_name, return_dtype=pl.Utf8).alias("servicer_from"),
-                pl.col(COL_ISSUER).map_elements(issuer_name, return_dtype=pl.Utf8).alias("servicer_to"),
-            ).select(
-                "seller_issuer_id", "servicer_from",
-                "issuer_id", "servicer_to",
-                "transition_month",
-                "n_loans", "total_upb",
-                "frac_seller_n", "frac_seller_upb",
-                "frac_buyer_n", "frac_buyer_upb",
-            )
-
-            all_results.append(agg)
-
-        elapsed = time.perf_counter() - t0
-
-        if (i + 1) % 12 == 0 or i == len(months) - 1:
-            print(
-                f"  {month}: {total:>10,} loans, {n_transfers:>8,} transfers ({pct:>5.2f}%)  "
-                f"[{elapsed:.1f}s]  ({i+1}/{len(months)})"
-            )
-
-        del df_month, transfers, month_frames, servicer_totals
-        gc.collect()
-
-    total_elapsed = time.perf_counter() - t_total
-    print(f"\nAll months processed in {total_elapsed / 60:.1f} minutes")
-
-    # -----------------------------------------------------------------------
-    # Combine, sort, write CSV
-    # -----------------------------------------------------------------------
-    if not all_results:
-        print("No transfers detected.")
-        return
-
-    combined = pl.concat(all_results).sort(
-        ["transition_month", "n_loans"], descending=[False, True]
-    )
-
-    OUTPUT_CSV.parent.mkdir(parents=True, exist_ok=True)
-    combined.write_csv(OUTPUT_CSV)
-
-    print(f"\nWrote {combined.height:,} rows to {OUTPUT_CSV}")
-    print(f"Total loan-level transfers: {combined['n_loans'].sum():,}")
-    print(f"Total UPB transferred: ${combined['total_upb'].sum() / 1e9:,.1f}B")
-    print(f"Unique (from, to) pairs: {combined.select('servicer_from', 'servicer_to').unique().height:,}")
+        # Stream the sorted result straight to disk rather than materializing it
+        OUTPUT_CSV.parent.mkdir(parents=True, exist_ok=True)
+        schema = combined.collect_schema()
+        combined.sink_csv(OUTPUT_CSV)
+
+    # Summarize from the written CSV so the joins and sort above run only once
+    written = pl.scan_csv(OUTPUT_CSV, schema=schema)
+    summary, top20 = pl.collect_all([
+        written.select(
+            pl.len().alias("n_rows"),
+            pl.col("n_loans").sum(),
+            pl.col("total_upb").sum(),
+            pl.struct("servicer_from", "servicer_to").n_unique().alias("n_pairs"),
+        ),
+        written.sort("n_loans", descending=True).head(20),
+    ])
+    n_rows, n_loans, total_upb, n_pairs = summary.row(0)
+
+    print(f"\nWrote {n_rows:,} rows to {OUTPUT_CSV}")
+    print(f"Total loan-level transfers: {n_loans:,}")
+    print(f"Total UPB transferred: ${total_upb / 1e9:,.1f}B")
+    print(f"Unique (from, to) pairs: {n_pairs:,}")
 
     # -----------------------------------------------------------------------
     # Top 20 largest single-month transitions
@@ -286,8 +306,7 @@ def main():
     print("TOP 20 LARGEST SINGLE-MONTH TRANSITIONS")
     print("=" * 120)
 
-    top20 = combined.sort("n_loans", descending=True).head(20)
-    for row in top20.iter_rows(named=True):
+    for row in top20.rows(named=True):
         print(
             f"  {row['transition_month']}: "
             f"{row['servicer_from'][:40]:40s} -> {row['servicer_to'][:40]:40s} "
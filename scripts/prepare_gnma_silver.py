@@ -0,0 +1,151 @@
+"""
+One-time preparation of GNMA llmon1/llmon2 L files for servicer change detection.
+
+The investigation script only needs 5 columns per loan, but the raw L parquet
+files need the same clean-up on every run: picking the loan sequence column
+for the file's vintage, nulling blank Seller Issuer IDs, and parsing UPB from
+a string in cents to dollars. This script does that once per file and writes
+the result as uncompressed Arrow IPC, which Polars memory-maps on read.
+
+Files whose IPC copy is newer than the source parquet are skipped, so re-runs
+only process newly added months. Each IPC directory carries a version stamp;
+when PREP_VERSION changes, every copy in it is rebuilt. The GNMA investigation
+script calls prepare_all() during discovery, so it never reads a stale or
+missing month.
+
+Output: data/gnma/silver/llmon{1,2}/L_ipc/llmon{1,2}_YYYYMM_L.arrow
+"""
+
+import time
+from pathlib import Path
+
+import polars as pl
+
+# ---------------------------------------------------------------------------
+# Paths
+# ---------------------------------------------------------------------------
+LLMON1_L_DIR = Path("data/gnma/silver/llmon1/L/")
+LLMON2_L_DIR = Path("data/gnma/silver/llmon2/L/")
+LLMON1_IPC_DIR = Path("data/gnma/silver/llmon1/L_ipc/")
+LLMON2_IPC_DIR = Path("data/gnma/silver/llmon2/L_ipc/")
+
+# ---------------------------------------------------------------------------
+# Column names
+# ---------------------------------------------------------------------------
+COL_ISSUER = "Issuer ID (including for loan packages in MIP pool)"
+COL_SELLER = "Seller Issuer ID"
+COL_UPB = "Unpaid Principal Balance (UPB of the loan)"
+COL_POOL = "Pool ID"
+COL_LOAN_NEW = "Disclosure Sequence Number (A sequence number unique to loan level)"
+COL_LOAN_OLD = "Disclosure Sequence Number (A sequence number unique to loan level )"  # trailing space
+COL_LOAN = "loan_seq"
+
+# Bump whenever prepare_file's cleaning changes, so existing IPC copies are
+# rebuilt instead of being trusted on mtime alone
+PREP_VERSION = "2"
+VERSION_STAMP = "PREP_VERSION"
+
+
+def extract_month(f: Path) -> str:
+    """Extract YYYYMM from filename like llmon1_201504_L.parquet."""
+    return f.stem.split("_")[1]
+
+
+def resolve_loan_col(f: Path) -> str | None:
+    """Return the loan sequence column name used by a file's vintage, if any."""
+    schema_cols = pl.scan_parquet(f).collect_schema().names()
+
+    if COL_LOAN_NEW in schema_cols:
+        return COL_LOAN_NEW
+    if COL_LOAN_OLD in schema_cols:
+        return COL_LOAN_OLD
+    return None
+
+
+def prepare_file(src: Path, dst: Path, loan_col: str) -> None:
+    """Write the cleaned 5-column projection of one L file as Arrow IPC."""
+    tmp = dst.with_name(dst.name + ".tmp")
+    (
+        # 5 projected columns: decode row groups in parallel, not columns
+        pl.scan_parquet(src, parallel="row_groups")
+        .select(
+            pl.col(COL_POOL),
+            pl.col(loan_col).alias(COL_LOAN),
+            pl.col(COL_ISSUER),
+            pl.when(pl.col(COL_SELLER).str.strip_chars() != "")
+            .then(pl.col(COL_SELLER))
+            .alias(COL_SELLER),
+            # UPB is stored as a string in cents; a non-strict cast already
+            # turns blank values into null
+            (pl.col(COL_UPB).str.strip_chars().cast(pl.Float64, strict=False) / 100).alias(
+                "upb_dollars"
+            ),
+        )
+        # Uncompressed so the investigation script can memory-map it
+        .sink_ipc(tmp, compression="uncompressed")
+    )
+    # Only expose complete files, so an interrupted run is redone next time
+    tmp.replace(dst)
+
+
+def prepare_all() -> tuple[list[Path], list[Path]]:
+    """Bring the IPC copies of all llmon1/llmon2 L files (Apr 2015+) up to date.
+
+    Returns the llmon1 and llmon2 IPC paths, one per source file that has a
+    loan sequence column, so callers read exactly the months the raw L files
+    cover.
+    """
+    t_total = time.perf_counter()
+    n_written = 0
+    n_current = 0
+    prepared: list[list[Path]] = []
+
+    for src_dir, dst_dir, pattern in [
+        (LLMON1_L_DIR, LLMON1_IPC_DIR, "llmon1_*_L.parquet"),
+        (LLMON2_L_DIR, LLMON2_IPC_DIR, "llmon2_*_L.parquet"),
+    ]:
+        dst_dir.mkdir(parents=True, exist_ok=True)
+        src_files = [f for f in sorted(src_dir.glob(pattern)) if extract_month(f) >= "201504"]
+
+        # Copies from another prep version are all stale; drop the stamp first
+        # so an interrupted rebuild is redone next time
+        stamp = dst_dir / VERSION_STAMP
+        version_current = stamp.exists() and stamp.read_text().strip() == PREP_VERSION
+        if not version_current:
+            stamp.unlink(missing_ok=True)
+
+        dst_files: list[Path] = []
+        for src in src_files:
+            dst = dst_dir / f"{src.stem}.arrow"
+            if version_current and dst.exists() and dst.stat().st_mtime >= src.stat().st_mtime:
+                n_current += 1
+                dst_files.append(dst)
+                continue
+
+            loan_col = resolve_loan_col(src)
+            if loan_col is None:
+                print(f"  {src.name}: no loan sequence column, skipped")
+                continue
+
+            t0 = time.perf_counter()
+            prepare_file(src, dst, loan_col)
+            n_written += 1
+            dst_files.append(dst)
+            print(f"  {src.name} -> {dst}  [{time.perf_counter() - t0:.1f}s]")
+
+        stamp.write_text(PREP_VERSION)
+        prepared.append(dst_files)
+
+    total_elapsed = time.perf_counter() - t_total
+    print(f"\nWrote {n_written} IPC files ({n_current} already current) in {total_elapsed / 60:.1f} minutes")
+
+    llmon1_files, llmon2_files = prepared
+    return llmon1_files, llmon2_files
+
+
+def main():
+    prepare_all()
+
+
+if __name__ == "__main__":
+    main()